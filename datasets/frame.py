@@ -4,13 +4,16 @@ from pathlib import Path
 from typing import Optional
 from contextlib import nullcontext
 
+# Third-Party Library
+import numpy as np
+
 # Torch Library
 import torch
 import torchvision
 import torch.nn as nn
 
 # My Library
-from .transforms import SameRandomStateContext
+from .transforms import SameRandomStateContext, SeededRandomStateContext
 from .transforms import get_crop_transform, get_img_transform
 
 
@@ -46,10 +49,26 @@ class FrameReader:
         self.same_transform = same_crop_transform
         self.is_flow_img: bool = modality == "flow"
 
+        # UTF-8 encoded names of the indexed clips, so a clip can be loaded by its index
+        self._video_names: Optional[np.ndarray] = None
+
     @staticmethod
     def get_image_name(name: int) -> str:
         return f"{name:06d}.jpg"
 
+    def index_videos(self, video_names: np.ndarray) -> None:
+        """ Index the clips by a fixed-length bytes array of UTF-8 encoded names, so `exists` and `load_frames` also accept the index of a clip in `video_names` """
+        # keep the array itself, the path of a clip is built when it is loaded
+        self._video_names = video_names
+
+    def get_clip_dir(self, clip: str | int) -> Path:
+        """ Return the dir of a clip given its name or its index """
+        return self.clip_dir.joinpath(clip if isinstance(clip, str) else self._video_names[clip].decode())
+
+    def exists(self, clip: str | int) -> bool:
+        """ Check if the frames of the clip exist, i.e., the first frame of the clip is on the disk """
+        return self.get_clip_dir(clip).joinpath(self.get_image_name(0)).is_file()
+
     def _read_frame(self, frame_path: Path) -> torch.FloatTensor:
         """ Read an image frame from the given path and return it as a torch.FloatTensor.  """
         img: torch.Tensor = torchvision.io.read_image(
@@ -60,8 +79,8 @@ class FrameReader:
 
     def load_frames(
         self,
-        # The name of the video
-        clip_name: str,
+        # The name of the video, or its index given to `index_videos`
+        clip: str | int,
         # Start frame of the clip
         start_frame: int,
         # End frame of the clip
@@ -71,76 +90,114 @@ class FrameReader:
         # Sample stride of the clip
         frame_sample_stride: int = 1,
         # If doing random sample
-        random_sample: bool = False
+        random_sample: bool = False,
+        # Seed of the random crop and sample of the clip
+        seed: Optional[int] = None
     ) -> torch.FloatTensor:
         """
         Load frames from a video clip based on the specified parameters. Return [B, T, C, H, W] if img_transform contains multi-crop else return [T, C, H, W]. T for temporal
 
 
         Args:
-            video_name: The name of the video.
+            clip: The name of the video, or its index given to `index_videos`.
             start_frame: Start frame of the clip.
             end_frame: End frame of the clip.
             pad_end_frame: If padding the end frame (default is False).
             sample_stride: Sample stride of the clip (default is 1).
             random_sample: If doing random sample (default is False).
+            seed: Seed of the random crop and sample of the clip, crop transforms restore the random
+                state after each frame, so give a new seed to each clip to get a new crop. The random
+                state is restored after the clip is loaded (default is None, i.e., use current state).
 
         Returns:
             torch.FloatTensor: The loaded frames as a torch tensor.
         """
+        # seed the random crop and sample of this clip only, and leave the module-level random as it was
+        with SeededRandomStateContext(seed) if seed is not None else nullcontext():
+            # number of padding at the start or end of the clip
+            n_pad_end = 0
+            n_pad_start = 0
+
+            # dir containing all frames of the clip
+            clip_dir = self.get_clip_dir(clip)
 
-        # number of padding at the start or end of the clip
-        n_pad_end = 0
-        n_pad_start = 0
+            # containing all read frames to stack
+            all_frames: list[torch.FloatTensor] = []
 
-        # containing all read frames to stack
-        all_frames: list[torch.FloatTensor] = []
+            for frame_idx in range(start_frame, end_frame, frame_sample_stride):
+                if random_sample and frame_sample_stride > 1:
+                    frame_idx += random.randint(0, frame_sample_stride - 1)
 
-        for frame_idx in range(start_frame, end_frame, frame_sample_stride):
-            if random_sample and frame_sample_stride > 1:
-                frame_idx += random.randint(0, frame_sample_stride - 1)
+                if frame_idx < 0:
+                    n_pad_start += 1
+                    continue
 
-            if frame_idx < 0:
-                n_pad_start += 1
-                continue
+                frame_path = clip_dir.joinpath(self.get_image_name(frame_idx))
 
-            frame_path = self.clip_dir.joinpath(
-                clip_name, self.get_image_name(frame_idx))
+                try:
+                    # read the image from the disk
+                    img = self._read_frame(frame_path=frame_path)
 
-            try:
-                # read the image from the disk
-                img = self._read_frame(frame_path=frame_path)
+                    # crop the image if crop_transform is provided
+                    with SameRandomStateContext() if self.same_transform else nullcontext():
+                        img = self.crop_transform(
+                            img) if self.crop_transform else img
 
-                # crop the image if crop_transform is provided
-                with SameRandomStateContext() if self.same_transform else nullcontext():
-                    img = self.crop_transform(
-                        img) if self.crop_transform else img
+                    # transforms the image, [B, C, H, W] if multi-crop else [C, H, W]
+                    img = img if self.same_transform else self.image_transform(img)
 
-                # transforms the image, [B, C, H, W] if multi-crop else [C, H, W]
-                img = img if self.same_transform else self.image_transform(img)
+                    all_frames.append(img)
 
-                all_frames.append(img)
+                except RuntimeError:
+                    # if a frame is missing, then pad at the end of the tensor
+                    # print(warn(f"Missing frame {yellow(self.get_image_name(frame_idx))} for video {
+                    #       yellow(video_name)}, at clip {yellow(frame_path.parent.stem)}, skip this frame..."))
+                    n_pad_end += 1
 
-            except RuntimeError:
-                # if a frame is missing, then pad at the end of the tensor
-                # print(warn(f"Missing frame {yellow(self.get_image_name(frame_idx))} for video {
-                #       yellow(video_name)}, at clip {yellow(frame_path.parent.stem)}, skip this frame..."))
-                n_pad_end += 1
+            if all_frames:
+                # stack the images, [B, T, C, H, W] if multi-crop else [T, C, H, W]
+                ret = torch.stack(all_frames, dim=int(all_frames[0].ndim == 4))
 
-        if all_frames:
-            # stack the images, [B, T, C, H, W] if multi-crop else [T, C, H, W]
-            ret = torch.stack(all_frames, dim=int(all_frames[0].ndim == 4))
+                # always padding before the start_frame, and pad end_frame if required
+                if n_pad_start > 0 or (pad_end_frame and n_pad_end > 0):
+                    ret = nn.functional.pad(
+                        ret, (0, 0, 0, 0, 0, 0, n_pad_start,
+                              n_pad_end if pad_end_frame else 0)
+                    )
+            else:
+                ret = None
 
-            # always padding before the start_frame, and pad end_frame if required
-            if n_pad_start > 0 or (pad_end_frame and n_pad_end > 0):
-                ret = nn.functional.pad(
-                    ret, (0, 0, 0, 0, 0, 0, n_pad_start,
-                          n_pad_end if pad_end_frame else 0)
-                )
-        else:
-            ret = None
+            return ret
 
-        return ret
+    def load_frames_batch(
+        self,
+        # The names of the videos, or their indexes given to `index_videos`
+        clips: list[str | int],
+        # Start frames of the clips
+        start_frames: list[int],
+        # End frames of the clips
+        end_frames: list[int],
+        # If padding the end frame
+        pad_end_frame: bool = False,
+        # Sample stride of the clips
+        frame_sample_stride: int = 1,
+        # If doing random sample
+        random_sample: bool = False,
+        # Seeds of the random crop and sample of each clip
+        seeds: Optional[list[int]] = None
+    ) -> list[Optional[torch.FloatTensor]]:
+        """
+        Load frames of a batch of video clips, see `load_frames` for the arguments.
+
+        Returns:
+            list[Optional[torch.FloatTensor]]: The loaded frames of each clip, None if no frame of the clip is loaded.
+        """
+        return [
+            self.load_frames(clip, start_frame, end_frame, pad_end_frame=pad_end_frame,
+                             frame_sample_stride=frame_sample_stride, random_sample=random_sample, seed=seed)
+            for clip, start_frame, end_frame, seed in zip(
+                clips, start_frames, end_frames, [None] * len(clips) if seeds is None else seeds)
+        ]
 
 
 def get_frame_reader(
@@ -150,6 +207,7 @@ def get_frame_reader(
     same_crop_transform: bool,
     multi_crop: bool,
     crop_dim: Optional[int] = None,
+    video_names: Optional[np.ndarray] = None,
 ) -> FrameReader:
     """
     Create and return a FrameReader for reading frames of a clip in a dataset.
@@ -161,6 +219,7 @@ def get_frame_reader(
         modality: Modality of the frame.
         same_crop_transform: Flag indicating if using the same crop transform for all images.
         multi_crop: Flag indicating if multi-crop is used.
+        video_names: Fixed-length bytes array of UTF-8 encoded names of the clips to index, so the reader can load a clip by its index.
 
     Returns:
         FrameReader: A FrameReader for reading frames of a clip.
@@ -170,8 +229,11 @@ def get_frame_reader(
 
     img_transform = get_img_transform(is_eval, modality)
 
-    return FrameReader(clip_dir, modality, crop_transform,
-                       img_transform, same_crop_transform)
+    reader = FrameReader(clip_dir, modality, crop_transform,
+                         img_transform, same_crop_transform)
+    if video_names is not None:
+        reader.index_videos(video_names)
+    return reader
 
 
 if __name__ == "__main__":
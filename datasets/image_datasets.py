@@ -1,12 +1,23 @@
 # Standard Library
+import os
 import copy
 import random
+import zipfile
+import tempfile
+import weakref
+import contextlib
 from pathlib import Path
 from typing import Optional
+from functools import cached_property
 
 # Third-Party Library
 import numpy as np
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
 # Torch Library
 import torch
 import torch.utils.data as data
@@ -16,7 +27,7 @@ from .frame import get_frame_reader
 
 from utils.color import error, red
 from utils.io import load_json, load_yaml
-from utils.annotation import Annotation, HierarchalClass, Example
+from utils.annotation import Annotation, Event, HierarchalClass, Example
 
 
 def get_classes(class_txt: Path) -> dict[str, int]:
@@ -47,9 +58,63 @@ def get_hierarchal_classes(class_yaml: Path) -> HierarchalClass:
     return {"num_level": num_level, "num_trans": num_trans, "level_dict": level_dict, "trans_dict": trans_dict}
 
 
+def _dilate_labels(
+    labels: np.ndarray,
+    event_frames: np.ndarray,
+    event_classes: np.ndarray,
+    start_frame: int,
+    frame_sample_stride: int,
+    dilate_len: int,
+    clip_len: int
+) -> bool:
+    """ Write the dilated labels of the events into a zeroed array, compiled by numba if installed """
+    contains_event = False
+    for k in range(event_frames.shape[0]):
+        label_index = (event_frames[k] - start_frame) // frame_sample_stride
+        lo = max(0, label_index - dilate_len)
+        hi = min(clip_len, label_index + dilate_len + 1)
+        for i in range(lo, hi):
+            labels[:, i] = event_classes[:, k]
+        if lo < hi:
+            contains_event = True
+    return contains_event
+
+
+if numba is not None:
+    _dilate_labels = numba.njit(cache=True)(_dilate_labels)
+
+
+# ActionSpotDataset alive in this process. The generator of the samplers is copied into forked
+# workers, so drop it once after fork and let each worker recreate its own on the first sample
+_DATASETS: weakref.WeakSet = weakref.WeakSet()
+
+
+def _reset_rng_after_fork() -> None:
+    for dataset in _DATASETS:
+        dataset._rng = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_rng_after_fork)
+
+
+# Frames and labels of an example are returned as C-contiguous tensors, so the pinning
+# thread of DataLoader pins each of them in a single copy. Use pin_memory=True together
+# with the default prefetch_factor=2, a larger prefetch_factor only holds more pinned
+# memory without speeding up the training.
 class ActionSpotDataset(data.Dataset):
     """ dataset for training, validating and testing """
 
+    # attributes in slots instead of the instance dict, which is copied to every worker.
+    # clip_indexes is a cached_property, so it still lives in the __dict__ from data.Dataset
+    __slots__ = (
+        "label_file", "hierarchal_classes", "is_eval", "dilate_len", "event_sample_rate", "mixup",
+        "clip_len", "frame_sample_stride", "dataset_len", "n_pad_frames",
+        "uniform_sample_weight", "frame_reader", "_cdf", "_num_frames", "_video_names",
+        "_events_per_clip", "_fl_video", "_fl_frame", "_rng", "_start_offset",
+        "_range_const", "_event_lower_const", "_event_upper_const", "_label_buf"
+    )
+
     def __init__(
         self,
         # Dict of hierarchal classes
@@ -78,17 +143,32 @@ class ActionSpotDataset(data.Dataset):
         # Number of the frames to pad before/after the clip
         n_pad_frames: int = 5,
         # Sample event ratio
-        event_sample_rate: float = -1
+        event_sample_rate: float = -1,
+        # If drop the clips whose frames are missing before sampling
+        prevalidate: bool = False
     ) -> None:
         super().__init__()
 
         # save the parameters
         self.label_file: Path = label_file
-        self.clip_labels: list[Annotation] = load_json(
-            label_file)
         self.hierarchal_classes: HierarchalClass = hierarchal_classes
-        self.clip_indexes: dict[str, int] = {
-            x["video"]: i for i, x in enumerate(self.clip_labels)}
+
+        # keep the annotations as struct of arrays, so each example reads an array
+        # index instead of probing dicts, and fewer python objects are copied to workers
+        cache = self._build_or_load_cache(label_file)
+        self._num_frames: np.ndarray = cache["num_frames"]
+        # fixed-length bytes in a single buffer, so reading a name in a forked worker
+        # doesn't bump refcounts of per-name str objects and copy their pages
+        self._video_names: np.ndarray = np.char.encode(
+            cache["video_names"], "utf-8")
+        # Pre-parse the events of each clip into arrays, i.e., frames [num_events]
+        # and hierarchal class indexes [num_level, num_events], so that building
+        # the labels of an example is vectorized
+        event_classes = self._get_event_classes(cache["event_labels"])
+        split_idx = cache["event_offsets"][1:-1]
+        self._events_per_clip: list[tuple[np.ndarray, np.ndarray]] = list(zip(
+            np.split(cache["event_frames"], split_idx),
+            np.split(event_classes, split_idx, axis=1)))
         self.is_eval = is_eval
         self.dilate_len = dilate_len
         self.event_sample_rate = event_sample_rate
@@ -111,118 +191,282 @@ class ActionSpotDataset(data.Dataset):
         assert n_pad_frames >= 0, error(
             f"n_pad_frames should be greater equal than 0, got: {red(n_pad_frames, True)}")
 
+        # constants of the sampling bounds, i.e., start frame of a clip is sampled in
+        # [-n_pad_frames * stride, num_frames - 1 + (2 * n_pad_frames - clip_len) * stride]
+        self._start_offset: int = -n_pad_frames * frame_sample_stride
+        self._range_const: int = (
+            2 * n_pad_frames - clip_len) * frame_sample_stride - 1
+        # and the clip sampled for an event should cover the event frame
+        self._event_lower_const: int = 1 - clip_len * frame_sample_stride
+        self._event_upper_const: int = (
+            n_pad_frames - clip_len) * frame_sample_stride - 1
+
+        # Frame Reader
+        self.frame_reader = get_frame_reader(
+            clip_dir=clip_dir, is_eval=is_eval, modality=modality, crop_dim=crop_dim,
+            same_crop_transform=same_crop_transform, multi_crop=False,
+            video_names=self._video_names)
+
+        # drop the missing clips, so examples are rarely resampled in the worker
+        if prevalidate:
+            valid = np.asarray([self.frame_reader.exists(i)
+                               for i in range(len(self._video_names))], dtype=bool)
+            assert valid.any(), error(
+                f"no clip of {red(label_file, True)} is found in {red(clip_dir, True)}")
+            self._num_frames = self._num_frames[valid]
+            self._video_names = self._video_names[valid]
+            self._events_per_clip = [
+                e for e, v in zip(self._events_per_clip, valid) if v]
+            # keep the indexes of the reader in sync with the dataset
+            self.frame_reader.index_videos(self._video_names)
+
         # Sample based on foreground labels
         if self.event_sample_rate > 0:
-            self.flat_labels = []
-            for i, x, in enumerate(self.clip_labels):
-                for event in x["events"]:
-                    if event["frame"] < x["num_frames"]:
-                        self.flat_labels.append((i, event["frame"]))
+            # events of all clips concatenated, and the clip index of each event
+            event_frames = np.concatenate([f for f, _ in self._events_per_clip])
+            event_clips = np.repeat(
+                np.arange(len(self._events_per_clip)), [len(f) for f, _ in self._events_per_clip])
+            mask = event_frames < self._num_frames[event_clips]
+            self._fl_video = event_clips[mask].astype(np.int32)
+            self._fl_frame = event_frames[mask].astype(np.int32)
 
         # Sample based on the clip length
-        num_frames = [c["num_frames"] for c in self.clip_labels]
-        self.uniform_sample_weight = np.array(num_frames) / np.sum(num_frames)
+        self.uniform_sample_weight = self._num_frames / np.sum(self._num_frames)
+        # cumulative weights, so sampling a clip is a binary search
+        self._cdf = np.cumsum(self.uniform_sample_weight)
+        self._cdf[-1] = 1.0
 
-        # Frame Reader
-        self.frame_reader = get_frame_reader(
-            clip_dir=clip_dir, is_eval=is_eval, modality=modality, crop_dim=crop_dim,
-            same_crop_transform=same_crop_transform, multi_crop=False)
+        # buffer to build the labels, allocated on first use so each worker owns its buffer
+        self._label_buf: Optional[np.ndarray] = None
 
-    def sample_clip(self) -> tuple[Annotation, int]:
+        # random generator of the samplers, created here and recreated in each worker
+        self._rng: Optional[random.Random] = None
+        self._seed_rng()
+        _DATASETS.add(self)
+
+    @staticmethod
+    def _build_or_load_cache(label_file: Path) -> dict[str, np.ndarray]:
+        """
+        Load the annotations from the `.npz` cache next to the label json, parsing the json and
+        writing the cache if the cache is missing or older than the json.
+
+        Args:
+            label_file: Path to the label json.
+
+        Returns:
+            dict[str, np.ndarray]: Annotations as struct of arrays, i.e., `num_frames` and `video_names`
+                of each clip, `event_frames` and `event_labels` of all events concatenated, and
+                `event_offsets` of the events of each clip, shape [num_clips + 1].
+        """
+        cache_keys = ("num_frames", "video_names", "event_frames", "event_labels", "event_offsets")
+
+        cache_file = label_file.with_suffix(".npz")
+        if cache_file.exists() and cache_file.stat().st_mtime >= label_file.stat().st_mtime:
+            # a broken cache, e.g., an empty file or one left by an old version, is treated as missing
+            with contextlib.suppress(zipfile.BadZipFile, EOFError, KeyError, ValueError, OSError):
+                with np.load(cache_file) as f:
+                    return {k: f[k] for k in cache_keys}
+
+        clip_labels: list[Annotation] = load_json(label_file)
+        events: list[Event] = [e for c in clip_labels for e in c["events"]]
+        cache = {
+            "num_frames": np.asarray([c["num_frames"] for c in clip_labels], dtype=np.int32),
+            "video_names": np.asarray([c["video"] for c in clip_labels], dtype=str),
+            "event_frames": np.asarray([e["frame"] for e in events], dtype=np.int64),
+            "event_labels": np.asarray([e["label"] for e in events], dtype=str),
+            "event_offsets": np.cumsum([0] + [len(c["events"]) for c in clip_labels], dtype=np.int64),
+        }
+
+        # the cache is only an optimization, so skip it if the label dir is read-only. Write to
+        # a temp file and move it into place, so a killed or concurrent run never reads a partial cache
+        with contextlib.suppress(OSError):
+            fd, tmp_file = tempfile.mkstemp(
+                prefix=f"{cache_file.name}.", suffix=".tmp", dir=cache_file.parent)
+            try:
+                with os.fdopen(fd, mode="wb") as f:
+                    np.savez(f, **cache)
+                os.replace(tmp_file, cache_file)
+            finally:
+                # nothing to remove once the temp file is moved
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(tmp_file)
+        return cache
+
+    def _get_event_classes(self, event_labels: np.ndarray) -> np.ndarray:
+        """
+        Map the labels of the events to the class indexes of each level.
+
+        Args:
+            event_labels: Labels of the events, shape [num_events].
+
+        Returns:
+            np.ndarray: Class indexes of the events at each level, shape [num_level, num_events].
+        """
+        num_level = self.hierarchal_classes["num_level"]
+        level_dict = self.hierarchal_classes["level_dict"]
+        trans_dict = self.hierarchal_classes["trans_dict"]
+
+        # only a few distinct labels, so map them once and gather for all events
+        unique_labels, inverse = np.unique(event_labels, return_inverse=True)
+        table = np.zeros((num_level, len(unique_labels)), dtype=np.int16)
+        for k, level0_label in enumerate(unique_labels.tolist()):
+            # label of the first level
+            table[0, k] = level_dict[0][level0_label]
+
+            # label of the rest level
+            for level_idx in range(1, num_level):
+                level_label = trans_dict[level_idx - 1][level0_label]
+                table[level_idx, k] = level_dict[level_idx][level_label]
+        return table[:, inverse]
+
+    def sample_clip(self) -> tuple[int, int]:
         """
         Uniformly samples a clip label and start frame based on specified parameters.
 
         Returns:
-            tuple[Annotation, int]: A tuple containing the sampled clip label and start frame.
+            tuple[int, int]: A tuple containing the index of the sampled clip label and start frame.
         """
-        clip_label = random.choices(
-            self.clip_labels, weights=self.uniform_sample_weight)[0]
+        clip_idx = int(np.searchsorted(self._cdf, self._rng.random(), side="right"))
 
-        clip_frames = clip_label["num_frames"]
+        clip_frames = int(self._num_frames[clip_idx])
         # every time we sample a same clip, we would like it having some frame-shifting, i.e.
         # the first time we sample clip A from frame 0 to frame 100
         # the next time we sample clip A again, we would like it from 10-110
         # so with some frame-shifting, we increase the total amount of training examples
-        start_frame = -self.n_pad_frames * self.frame_sample_stride + random.randint(
-            0, max(0, clip_frames - 1 + (2 * self.n_pad_frames - self.clip_len) * self.frame_sample_stride))
-        return clip_label, start_frame
+        start_frame = self._start_offset + self._rng.randint(
+            0, max(0, clip_frames + self._range_const))
+        return clip_idx, start_frame
 
-    def sample_event(self) -> tuple[Annotation, int]:
+    def sample_event(self) -> tuple[int, int]:
         """
         Uniformly samples a event label and start frame based on specified parameters.
 
         Returns:
-            tuple[Annotation, int]: A tuple containing the sampled event label and start frame.
+            tuple[int, int]: A tuple containing the index of the sampled clip label and start frame.
         """
-        video_idx, frame_idx = random.choices(self.flat_labels)[0]
-        clip_label = self.clip_labels[video_idx]
-        video_len = clip_label['num_frames']
+        k = self._rng.randrange(self._fl_video.shape[0])
+        video_idx, frame_idx = int(self._fl_video[k]), int(self._fl_frame[k])
+        video_len = int(self._num_frames[video_idx])
 
         lower_bound = max(
-            -self.n_pad_frames * self.frame_sample_stride,
-            frame_idx - self.clip_len * self.frame_sample_stride + 1)
+            self._start_offset, frame_idx + self._event_lower_const)
         upper_bound = min(
-            video_len - 1 + (self.n_pad_frames - self.clip_len) *
-            self.frame_sample_stride,
-            frame_idx)
+            video_len + self._event_upper_const, frame_idx)
 
-        start_frame = random.randint(lower_bound, upper_bound) \
+        start_frame = self._rng.randint(lower_bound, upper_bound) \
             if upper_bound > lower_bound else lower_bound
 
         assert start_frame <= frame_idx
         assert start_frame + self.clip_len > frame_idx
-        return clip_label, start_frame
+        return video_idx, start_frame
+
+    def get_sample(self) -> tuple[int, int]:
+        if self._rng is None:
+            self._seed_rng()
 
-    def get_sample(self) -> tuple[Annotation, int]:
         # because event is rarely sparse in the clip, so we need to sample
         # the event to increase the training examples
-        if self.event_sample_rate > 0 and random.random() > self.event_sample_rate:
-            clip_label, start_frame = self.sample_event()
+        if self.event_sample_rate > 0 and self._rng.random() > self.event_sample_rate:
+            clip_idx, start_frame = self.sample_event()
         else:
-            clip_label, start_frame = self.sample_clip()
-        return clip_label, start_frame
+            clip_idx, start_frame = self.sample_clip()
+        return clip_idx, start_frame
 
-    def get_example(self) -> Example:
-        clip_label, start_frame = self.get_sample()
+    def _fill_labels(self, labels: np.ndarray, clip_idx: int, start_frame: int) -> bool:
+        """
+        Write the hierarchal labels of a sampled clip into a zeroed array.
 
-        # build hierarchal labels
-        labels = {level_idx: np.zeros(self.clip_len) for level_idx in range(
-            self.hierarchal_classes["num_level"])}
+        Args:
+            labels: Zeroed labels to write, shape [num_level, clip_len].
+            clip_idx: Index of the sampled clip.
+            start_frame: Start frame of the sampled clip.
 
-        for event in clip_label["events"]:
-            event_frame = event["frame"]
+        Returns:
+            bool: If the clip contains an event.
+        """
+        event_frames, event_classes = self._events_per_clip[clip_idx]
+
+        # write the dilated labels in native code, compiled once per worker and cached on the disk
+        if self.dilate_len > 0 and numba is not None:
+            return _dilate_labels(
+                labels, event_frames, event_classes, start_frame,
+                self.frame_sample_stride, self.dilate_len, self.clip_len)
+
+        # calculate the index of the frames
+        label_index = (event_frames - start_frame) // self.frame_sample_stride
+        if self.dilate_len == 0:
+            mask = (label_index >= 0) & (label_index < self.clip_len)
+            labels[:, label_index[mask]] = event_classes[:, mask]
+        else:
+            lo = np.clip(label_index - self.dilate_len, 0, self.clip_len)
+            hi = np.clip(label_index + self.dilate_len + 1, 0, self.clip_len)
+            mask = lo < hi
+            # only a few events in a clip, so slice assignment is enough
+            for k in np.flatnonzero(mask):
+                labels[:, lo[k]:hi[k]] = event_classes[:, k, None]
+        # class indexes start from 1, so any event in the mask writes a foreground label
+        return bool(mask.any())
+
+    def _build_labels(self, clip_idx: int, start_frame: int) -> tuple[dict[int, torch.ShortTensor], bool]:
+        """
+        Build the hierarchal labels of a sampled clip.
 
-            # calculate the index of the frame
-            label_idx = (
-                event_frame - start_frame) // self.frame_sample_stride
-            if (label_idx >= -self.dilate_len and label_idx < self.clip_len + self.dilate_len):
+        Args:
+            clip_idx: Index of the sampled clip.
+            start_frame: Start frame of the sampled clip.
 
-                # modify the corresponding frame labels
-                for i in range(max(0, label_idx - self.dilate_len), min(self.clip_len, label_idx + self.dilate_len + 1)):
+        Returns:
+            tuple[dict[int, torch.ShortTensor], bool]: Labels of each level, each shape [clip_len], and if
+                the clip contains an event.
+        """
+        # build hierarchal labels, shape [num_level, clip_len]
+        if self._label_buf is None:
+            self._label_buf = np.zeros(
+                (self.hierarchal_classes["num_level"], self.clip_len), dtype=np.int16)
+        labels = self._label_buf
+        labels.fill(0)
+        contains_event = self._fill_labels(labels, clip_idx, start_frame)
+
+        # copy out of the buffer, since the example outlives this call, and wrap it as
+        # a tensor without copy, so the collate in the main process needn't convert it
+        labels = torch.from_numpy(labels.copy())
+        labels = {level_idx: labels[level_idx] for level_idx in range(
+            self.hierarchal_classes["num_level"])}
+        return labels, contains_event
 
-                    # label of the first level
-                    level0_label = event["label"]
+    def _seed_rng(self) -> None:
+        """ Create the random generator of current process, seeded by the DataLoader worker seed """
+        worker = data.get_worker_info()
+        # DataLoader also seeds the module-level random of the worker with worker.seed, so derive
+        # another stream from it. Outside a worker, follow the module-level random so random.seed() still works
+        seed = f"{worker.seed}-sampler" if worker is not None else random.getrandbits(64)
+        self._rng = random.Random(seed)
 
-                    # build the label for the first level
-                    labels[0][i] = self.hierarchal_classes["level_dict"][0][level0_label]
+    def __getstate__(self):
+        # a generator copied into a spawned worker would repeat the stream of the main process
+        state, slots = super().__getstate__()
+        return state, {**slots, "_rng": None}
 
-                    # build the label for the rest level
-                    last_level_label: str = level0_label
-                    for level_idx in range(1, self.hierarchal_classes["num_level"]):
-                        level_label: str = ""
-                        # get the label of current level
-                        for j in range(level_idx):
-                            level_label = self.hierarchal_classes["trans_dict"][j][last_level_label]
-                        labels[level_idx][i] = self.hierarchal_classes["level_dict"][level_idx][level_label]
+    def get_example(self) -> Example:
+        # resample until the frames are loaded, and only build the labels of that sample
+        frames = None
+        while frames is None:
+            clip_idx, start_frame = self.get_sample()
+
+            # load frames
+            frames = self.frame_reader.load_frames(
+                clip=clip_idx, start_frame=start_frame,
+                end_frame=start_frame + self.clip_len * self.frame_sample_stride,
+                pad_end_frame=True, frame_sample_stride=self.frame_sample_stride, random_sample=not self.is_eval,
+                seed=self._rng.getrandbits(64)
+            )
 
-        # load frames
-        frames = self.frame_reader.load_frames(
-            clip_name=clip_label["video"], start_frame=start_frame,
-            end_frame=start_frame + self.clip_len * self.frame_sample_stride,
-            pad_end_frame=True, frame_sample_stride=self.frame_sample_stride, random_sample=not self.is_eval
-        )
+        labels, contains_event = self._build_labels(clip_idx, start_frame)
+        assert frames.is_contiguous() and all(
+            level_label.is_contiguous() for level_label in labels.values()), error(
+            f"example of clip {red(clip_idx, True)} is not contiguous")
 
-        return {"frame": frames, "level": self.hierarchal_classes["num_level"], "label": labels, "contains_event": int(labels[0].sum() > 0)}
+        return {"frame": frames, "level": self.hierarchal_classes["num_level"], "label": labels, "contains_event": int(contains_event)}
 
     def __getitem__(self, unused) -> Example:
         """
@@ -230,18 +474,56 @@ class ActionSpotDataset(data.Dataset):
             {
                 "frame": torch.FloatTensor, shape [Temporal, Channel, Height, Width],
                 "level": int, level of the labels of the example,
-                "label": list[torch.FloatTensor], labels of each level, each shape [Temporal]
+                "label": dict[int, torch.ShortTensor], labels of each level, each shape [Temporal],
+                    call .long() before computing the cross entropy
                 "contains_event": bool, if contains event
             }
         """
-        example = self.get_example()
-        while example["frame"] is None:
-            example = self.get_example()
-        return example
+        return self.get_example()
+
+    def __getitems__(self, indices: list[int]) -> list[Example]:
+        """ Return a batch of examples at once, used by DataLoader instead of calling __getitem__ for each index """
+        samples = [self.get_sample() for _ in indices]
+        batch_frames = self.frame_reader.load_frames_batch(
+            clips=[c for c, _ in samples],
+            start_frames=[s for _, s in samples],
+            end_frames=[s + self.clip_len * self.frame_sample_stride for _, s in samples],
+            pad_end_frame=True, frame_sample_stride=self.frame_sample_stride, random_sample=not self.is_eval,
+            seeds=[self._rng.getrandbits(64) for _ in samples]
+        )
+
+        # build the labels of the batch in one block, shape [Batch, num_level, clip_len]
+        num_level = self.hierarchal_classes["num_level"]
+        labels = np.zeros((len(indices), num_level, self.clip_len), dtype=np.int16)
+        label_tensor = torch.from_numpy(labels)
+
+        examples: list[Example] = []
+        for b, ((clip_idx, start_frame), frames) in enumerate(zip(samples, batch_frames)):
+            # resample the failed ones one by one
+            if frames is None:
+                examples.append(self.get_example())
+                continue
+
+            contains_event = self._fill_labels(labels[b], clip_idx, start_frame)
+            example_labels = {
+                level_idx: label_tensor[b, level_idx] for level_idx in range(num_level)}
+            assert frames.is_contiguous() and all(
+                level_label.is_contiguous() for level_label in example_labels.values()), error(
+                f"example of clip {red(clip_idx, True)} is not contiguous")
+            examples.append({
+                "frame": frames, "level": num_level, "label": example_labels,
+                "contains_event": int(contains_event)
+            })
+        return examples
 
     def __len__(self):
         return self.dataset_len
 
+    @cached_property
+    def clip_indexes(self) -> dict[str, int]:
+        """ index of each clip by its name, built on first access """
+        return {v.decode(): i for i, v in enumerate(self._video_names.tolist())}
+
 
 class ActionSpotmAPDataset(data.Dataset):
     """ dataset for calculating mAP """
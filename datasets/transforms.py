@@ -20,6 +20,20 @@ class SameRandomStateContext:
         random.setstate(self.random_state)
 
 
+class SeededRandomStateContext:
+    """ Seed the module-level random inside the context, and restore its state on exit """
+
+    def __init__(self, seed: int):
+        self.seed = seed
+
+    def __enter__(self):
+        self.random_state = random.getstate()
+        random.seed(self.seed)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        random.setstate(self.random_state)
+
+
 IMAGENET_STD: list[float] = [0.229, 0.224, 0.225]
 IMAGENET_MEAN: list[float] = [0.485, 0.456, 0.406]
 
@@ -50,5 +50,5 @@ class HierarchalClass(TypedDict):
 class Example(TypedDict):
     frame: torch.FloatTensor
     level: int
-    label: list[torch.FloatTensor]
+    label: dict[int, torch.ShortTensor]
     contains_event: int